@@ -1,14 +1,49 @@
-import datetime
-import subprocess
-import random
-import urllib.request
-import socket
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import os
+import secrets
+import signal
+import string
+import tempfile
+import threading
 import time
 
-import socks
 import stem
 import stem.process
 import stem.control
+import urllib3.contrib.socks
+
+# S2K count indicator used by `tor --hash-password` (65536 bytes hashed)
+_S2K_INDICATOR = 0x60
+
+_PW_ALPHABET = string.ascii_letters + string.digits
+
+def _join(value):
+    """Comma separate a list of nodes, passing strings through"""
+    if isinstance(value, str):
+        return value
+    return ','.join(value)
+
+# How each tor_config option is rendered; anything else uses str
+_CONFIG_FORMATTERS = {
+    'ExcludeNodes': _join,
+    'ExcludeExitNodes': _join,
+    'ExitNodes': _join,
+    'EntryNodes': _join,
+}
+
+def _hash_password(passwd):
+    """Salted, iterated S2K hash of passwd in TOR's control-spec format"""
+    salt = os.urandom(8)
+    count = (16 + (_S2K_INDICATOR & 15)) << ((_S2K_INDICATOR >> 4) + 6)
+    data = salt + passwd.encode()
+    stream = (data * (count // len(data) + 1))[:count]
+    digest = hashlib.sha1(stream).digest()
+    return '16:%s%02X%s' % (salt.hex().upper(), _S2K_INDICATOR,
+                            digest.hex().upper())
 
 class BaseCircuit():
     """Class for controlling a TOR circuit
@@ -18,8 +53,12 @@ class BaseCircuit():
     circuit and configure follow on anonymization services.
 
     Args:
-        socks_ip: The ip for the SOCKS5 port to listen on
-        socks_port: The local port for the TOR SOCKS5 proxy
+        socks_ip: The ip for the SOCKS5 port to listen on.  A falsy
+            value disables the SOCKS5 proxy, which is only allowed for a
+            transparent proxy
+        socks_port: The local port for the TOR SOCKS5 proxy.  Default is
+            9050, or a port chosen by TOR when functioning as a
+            transparent proxy
         control_port: The local port open to control TOR.  Will be
             configured with a password
         data_dir: Directory for TOR to save it's data files
@@ -37,10 +76,14 @@ class BaseCircuit():
         trans_ip: The local IP Address for TOR to listen on if
             functioning as a transparent proxy.
         trans_port: The local port for TOR to listen on if functioning
-            as a transparent proxy
+            as a transparent proxy.  Exit IP probes go through the
+            SOCKS5 proxy, which stays enabled alongside it
         verbose: Turn verbose output on or off
+
+    TOR is not launched until start() is called or the Circuit is
+    first used.
     """
-    def __init__(self, socks_ip = '127.0.0.1', socks_port = 9050,
+    def __init__(self, socks_ip = '127.0.0.1', socks_port = None,
                  control_port=9051, data_dir = False,
                  exclude_nodes = None, exclude_exits = None,
                  exit_nodes = None, entry_nodes = None,
@@ -48,100 +91,322 @@ class BaseCircuit():
                  verbose = False):
 
         self.verbose = verbose
-        self.tor_config = []
         self.control_port = control_port
 
-        if socks_ip and socks_port:
-            self.ip = socks_ip
-            self.port = socks_port
-            self.tor_config['SocksPort'] = '%s:%s' % (socks_ip, socks_port),
-        elif trans_ip and trans_port:
+        #Create tor configuration
+        self.tor_config = {
+            'ControlPort': '%s' % control_port,
+        }
+
+        use_socks = bool(socks_ip) and socks_port != 0
+
+        if trans_ip and trans_port:
             self.ip = trans_ip
             self.port = trans_port
             self.tor_config['TransPort'] = '%s:%s' % (trans_ip, trans_port)
+            if socks_port is None:
+                # TransPort does not speak SOCKS, so exit IP probes need
+                # a SOCKS port too.  A fixed default would collide with a
+                # default LocalTorTunnel, so let tor pick one
+                socks_port = 'auto'
+        elif use_socks:
+            if socks_port is None:
+                socks_port = 9050
+            self.ip = socks_ip
+            self.port = socks_port
         else:
-            self._err('Did not supply configuration details for a transparent'
-                      'proxy or socks proxy.')
+            raise ValueError('Did not supply configuration details for a '
+                             'transparent proxy or socks proxy.')
 
-        #Create tor configuration
-        self.tor_config = {
-            'ControlPort': '%s' % control_port,
-        }
+        if use_socks:
+            self.socks_ip = socks_ip
+            self.socks_port = None if socks_port == 'auto' else socks_port
+            self.tor_config['SocksPort'] = '%s:%s' % (socks_ip, socks_port)
+        else:
+            # otherwise tor opens its default SocksPort 9050 anyway
+            self.socks_ip = self.socks_port = None
+            self.tor_config['SocksPort'] = '0'
 
-        self.add_to_config('DataDir', data_dir)
+        self.add_to_config('DataDirectory', data_dir)
 
         self.add_to_config('ExcludeNodes', exclude_nodes)
         if exclude_nodes:
             self.tor_config['StrictNodes'] = '0'
 
-        self.add_to_config('ExcludeExits', exclude_exits)
+        self.add_to_config('ExcludeExitNodes', exclude_exits)
         self.add_to_config('ExitNodes', exit_nodes)
         self.add_to_config('EntryNodes', entry_nodes)
 
         self.control_passwd = self.gen_passwd()
-        self.tor_config['HashedControlPassword'] = self.get_hash(self.control_passwd)
 
-        self.proc = stem.process.launch_tor_with_config(
-            self.tor_config,
-            init_msg_handler = self._log,
-            take_ownership = True)
+        self._exit_ip_cache = (None, 0.0)
+        self._exit_ip_ttl = 300
+
+        self.proc = None
+        self._start_lock = threading.Lock()
+        self._launching = False
+        self._stopped = False
+        self._data_dir = None
+        self._pid_dir = None
+
+    @staticmethod
+    def pool(n, base_port = 9050,
+             timeout = stem.process.DEFAULT_INIT_TIMEOUT, **kwargs):
+        """Launch n Circuits concurrently
+
+        Each Circuit gets its own SOCKS5 port, control port and
+        temporary data directory, allocated in pairs upwards from
+        base_port.  TOR bootstraps overlap rather than running one after
+        another.  If any Circuit fails or does not bootstrap within
+        timeout seconds, all of them are stopped.
+
+        Args:
+            n: number of Circuits to launch
+            base_port: SOCKS5 port of the first Circuit.  Its control
+                port is base_port + 1
+            timeout: seconds to wait for every Circuit to bootstrap
+            kwargs: passed on to the BaseCircuit constructor
+
+        Returns:
+            A CircuitPool of the started Circuits, in port order
+        """
+        if n < 1:
+            raise ValueError('A pool needs at least one Circuit, got %r' % n)
+
+        circuits = []
+        for i in range(n):
+            data_dir = tempfile.TemporaryDirectory(
+                prefix = 'hecate-', ignore_cleanup_errors = True)
+            c = BaseCircuit(socks_port = base_port + 2 * i,
+                            control_port = base_port + 2 * i + 1,
+                            data_dir = data_dir.name,
+                            **kwargs)
+            c._data_dir = data_dir
+            # lets stop() find tor before launch_tor_with_config returns
+            c.tor_config['PidFile'] = os.path.join(data_dir.name, 'tor.pid')
+            circuits.append(c)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = n) as ex:
+            # stem's launch timeout relies on SIGALRM, which is only
+            # available on the main thread, so it is enforced here
+            futures = [ex.submit(c.start, None) for c in circuits]
+            done, not_done = concurrent.futures.wait(
+                futures, timeout,
+                return_when = concurrent.futures.FIRST_EXCEPTION)
+            errors = [f.exception() for f in done if f.exception()]
+            if errors or not_done:
+                # unblocks stragglers so the executor can shut down
+                for c in circuits:
+                    c._kill()
+
+        if errors or not_done:
+            # a launch may have completed while the others were killed
+            for c in circuits:
+                c.stop()
+            if errors:
+                raise errors[0]
+            raise OSError('reached a %i second timeout without success'
+                          % timeout)
+
+        return CircuitPool([f.result() for f in futures])
+
+    def start(self, timeout = stem.process.DEFAULT_INIT_TIMEOUT):
+        """Launch TOR if it is not already running
+
+        stem enforces timeout with SIGALRM, which only works on the main
+        thread.  When started from any other thread, a watchdog thread
+        kills TOR instead once timeout expires.
+
+        Args:
+            timeout: seconds to wait for TOR to bootstrap, or None to
+                wait indefinitely
+
+        Returns:
+            The Circuit, for convenience when starting from an executor
 
-        self.controller = stem.control.Controller.from_port(port = self.control_port)
-        if self.controller.authenticate(self.control_passwd):
+        Raises:
+            RuntimeError: if the Circuit has been stopped
+            OSError: if TOR fails to launch or bootstrap in time
+        """
+        with self._start_lock:
+            if self._stopped:
+                raise RuntimeError('Circuit has been stopped')
+            if self.proc is None:
+                self.tor_config['HashedControlPassword'] = \
+                    self.get_hash(self.control_passwd)
+                if threading.current_thread() is threading.main_thread():
+                    self._launch(timeout)
+                else:
+                    self._launch_with_watchdog(timeout)
+        return self
+
+    def _launch(self, timeout):
+        self._launching = True
+        try:
+            self.proc = stem.process.launch_tor_with_config(
+                self.tor_config,
+                timeout = timeout,
+                init_msg_handler = self._log,
+                take_ownership = True)
+        finally:
+            self._launching = False
+
+    def _launch_with_watchdog(self, timeout):
+        if timeout is None:
+            return self._launch(None)
+
+        if 'PidFile' not in self.tor_config:
+            # gives the watchdog a handle on tor while it bootstraps
+            self._pid_dir = tempfile.TemporaryDirectory(
+                prefix = 'hecate-', ignore_cleanup_errors = True)
+            self.tor_config['PidFile'] = os.path.join(
+                self._pid_dir.name, 'tor.pid')
+
+        expired = threading.Event()
+        def expire():
+            expired.set()
+            self._kill()
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            self._launch(None)
+        except OSError:
+            if expired.is_set():
+                raise OSError('reached a %i second timeout without '
+                              'success' % timeout) from None
+            raise
+        finally:
+            watchdog.cancel()
+            watchdog.join()
+
+        if expired.is_set():
+            # fired just as the launch completed
+            self._kill()
+            raise OSError('reached a %i second timeout without success'
+                          % timeout)
+
+    def stop(self):
+        """Stop TOR and remove any temporary data directory
+
+        Safe to call more than once.  A stopped Circuit cannot be
+        started again.
+        """
+        self._stopped = True
+        self._kill()
+        if self._data_dir is not None:
+            self._data_dir.cleanup()
+            self._data_dir = None
+        if self._pid_dir is not None:
+            self._pid_dir.cleanup()
+            self._pid_dir = None
+
+    def _kill(self):
+        controller = self.__dict__.pop('controller', None)
+        if controller is not None:
+            controller.close()
+        http = self.__dict__.pop('_http', None)
+        if http is not None:
+            http.clear()
+        self._exit_ip_cache = (None, 0.0)
+
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        elif self._launching and 'PidFile' in self.tor_config:
+            # tor is still bootstrapping inside launch_tor_with_config,
+            # so the pid file is the only handle on it
+            try:
+                with open(self.tor_config['PidFile']) as f:
+                    os.kill(int(f.read()), signal.SIGTERM)
+            except (OSError, ValueError):
+                pass
+
+    @functools.cached_property
+    def controller(self):
+        """Authenticated stem Controller for the Circuit's TOR process"""
+        self.start()
+        controller = stem.control.Controller.from_port(port = self.control_port)
+        if controller.authenticate(self.control_passwd):
             self._log('Tunnel started')
+        return controller
+
+    @functools.cached_property
+    def _http(self):
+        """Keep-alive connection pool bound to the SOCKS5 listener"""
+        ip, port = self._socks_address()
+        return urllib3.contrib.socks.SOCKSProxyManager(
+            'socks5h://%s:%s' % (ip, port),
+            maxsize = 4)
+
+    def _socks_address(self):
+        """Start TOR and get the (ip, port) of its SOCKS5 listener"""
+        if self.socks_ip is None:
+            raise ValueError('Circuit has no SOCKS5 proxy to probe the '
+                             'exit IP through')
+        self.start()
+        if self.socks_port is None:
+            listeners = self.controller.get_listeners(
+                stem.control.Listener.SOCKS)
+            self.socks_ip, self.socks_port = listeners[0]
+        return self.socks_ip, self.socks_port
 
     def add_to_config(self, key, value):
         """Add a key, value pair to tor_config if value is supplied
 
         Add a key,value pair to self.tor_config.  Ensures value is a
-        string.
+        string, formatted according to _CONFIG_FORMATTERS.
         """
         if value:
-            if value is list:
-                self.tor_config[key] = ','.join(value)
-            else:
-                self.tor_config[key] = str(value)
+            self.tor_config[key] = _CONFIG_FORMATTERS.get(key, str)(value)
 
     def gen_passwd(self):
         """Generates a 20 character alphanumeric password
 
         Returns:
-            A 20 character pseudoranom alphanumeric string
+            A 20 character cryptographically random alphanumeric string
         """
-        chars = ('abcdefghijklmnopqrstuvwxyz',
-                 'ABCDEFGHIJKLMNOPQRSTUVWXYZ123456890')
-        return ''.join(random.choice(chars) for _ in range(20))
+        return ''.join(secrets.choice(_PW_ALPHABET) for _ in range(20))
 
     def get_hash(self, passwd):
         """Gets the tor hashed password for a provided String
 
         Returns:
             A string containing the correct hash value for a TOR
-            password.
+            password.  Computed in process.
         """
-        return subprocess.getoutput('tor --hash-password %s' % passwd)
+        return _hash_password(passwd)
 
     def change_identity(self):
         """Get a new exit IP Address
 
-        Force the Circuit to get a new exit IP.  Utilizes either the
-        NEWNYM signal built into TOR or forcibly closes all currently
-        open circuits and reopens them
+        Force the Circuit to get a new exit IP using the NEWNYM signal
+        built into TOR.  If TOR is rate limiting NEWNYM, waits until it
+        is available again
 
         Returns:
             True if the IP Address has changed
         """
         start = self.get_exit_ip()
 
-        self.controller.authenticate(self.control_passwd)
-
-        if self.controller.is_newnym_available():
+        time.sleep(self.controller.get_newnym_wait())
+        try:
+            self.controller.signal(stem.Signal.NEWNYM)
+        except stem.SocketClosed:
+            self.controller.reconnect(password = self.control_passwd)
             self.controller.signal(stem.Signal.NEWNYM)
-        else:
-           for c in self.controller.get_circuits():
-               self.controller.close(c)
 
-        end = self.get_exit_ip()
+        # NEWNYM only affects new streams, so drop pooled keep-alive
+        # connections before every probe.  New circuits take a moment to
+        # be used, so poll with backoff rather than checking once
+        for attempt in range(5):
+            if attempt:
+                time.sleep(0.25 * 2 ** attempt)
+            self._http.clear()
+            end = self._fetch_exit_ip()
+            if end != start:
+                break
 
         return start != end
 
@@ -155,22 +420,74 @@ class BaseCircuit():
             Float of the time
         """
         start = time.time()
-        self.get_exit_ip()
+        self._fetch_exit_ip()
         return time.time() - start
 
     def get_exit_ip(self):
         """Gets the exit IP Address for the Circuit
 
-        Utilizes http://icanhazip.com and requires patching the socket
-        module.
+        Utilizes http://icanhazip.com over a keep-alive connection pool
+        bound to the Circuit's SOCKS5 proxy.  The result is cached for
+        _exit_ip_ttl seconds and invalidated by change_identity.
+
+        Returns:
+            A string containing the ip address
+        """
+        ip, ts = self._exit_ip_cache
+        if ip is not None and time.monotonic() - ts < self._exit_ip_ttl:
+            return ip
+        return self._fetch_exit_ip()
+
+    async def get_exit_ip_async(self):
+        """Gets the exit IP Address for the Circuit without blocking
+
+        Asynchronous version of get_exit_ip so many Circuits can be
+        probed from a single event loop.  Requires aiohttp and
+        aiohttp_socks.
 
         Returns:
             A string containing the ip address
         """
-        socks.set_default_proxy(socks.SOCKS5, self.ip, self.port)
-        socket.socket = socks.socksocket
-        r = urllib.request.urlopen('http://icanhazip.com')
-        return str(r.read()).strip()
+        import aiohttp
+        from aiohttp_socks import ProxyConnector
+
+        if self.proc is None:
+            # booting blocks for the whole bootstrap; keep the loop free
+            try:
+                await asyncio.wait_for(asyncio.to_thread(self.start),
+                                       stem.process.DEFAULT_INIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._kill()
+                raise
+        socks_ip, socks_port = await asyncio.to_thread(self._socks_address)
+        connector = ProxyConnector.from_url(
+            'socks5://%s:%s' % (socks_ip, socks_port), rdns = True)
+        async with aiohttp.ClientSession(connector = connector) as session:
+            async with session.get('http://icanhazip.com') as r:
+                ip = (await r.text()).strip()
+        self._exit_ip_cache = (ip, time.monotonic())
+        return ip
+
+    @staticmethod
+    def gather_ips(circuits):
+        """Probe the exit IP of many Circuits concurrently
+
+        Args:
+            circuits: iterable of Circuits, such as a CircuitPool
+
+        Returns:
+            List of ip address strings in the order of circuits
+        """
+        async def gather():
+            return await asyncio.gather(
+                *[c.get_exit_ip_async() for c in circuits])
+        return asyncio.run(gather())
+
+    def _fetch_exit_ip(self):
+        r = self._http.request('GET', 'http://icanhazip.com')
+        ip = r.data.decode().strip()
+        self._exit_ip_cache = (ip, time.monotonic())
+        return ip
 
     def _err(self, msg):
         print('[!!] %s %s' % (self._now(), msg))
@@ -183,10 +500,44 @@ class BaseCircuit():
         print('[*] %s %s' % (self._now(), msg))
 
     def _now(self):
-        return '{:%H:%M:%S}'.format(datetime.datetime.now())
+        return time.strftime('%H:%M:%S')
+
+class CircuitPool():
+    """A fixed set of running Circuits handed out round-robin
+
+    Args:
+        circuits: list of started Circuits
+    """
+    def __init__(self, circuits):
+        self.circuits = list(circuits)
+        self._cycle = itertools.cycle(self.circuits)
+
+    def next_circuit(self):
+        """Get the next Circuit in round-robin order"""
+        return next(self._cycle)
+
+    def close(self):
+        """Stop every Circuit and remove their data directories"""
+        for c in self.circuits:
+            c.stop()
+
+    def refresh_all_ips(self):
+        """Re-probe the exit IP of every Circuit in the pool
+
+        Returns:
+            List of ip address strings in pool order
+        """
+        return BaseCircuit.gather_ips(self.circuits)
+
+    def __iter__(self):
+        return iter(self.circuits)
+
+    def __len__(self):
+        return len(self.circuits)
 
 def main():
     bc = BaseCircuit(verbose=True)
+    bc.start()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
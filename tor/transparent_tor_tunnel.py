@@ -24,21 +24,16 @@ class TransparentTorTunnel(BaseCircuit):
             through. Relies on a given TOR node to publish its location
              so not guaranteed. Default is None.
         verbose: Turn verbose output on or off.  Default is off (False)
+
+    Other keyword arguments are passed on to BaseCircuit.
     """
 
     def __init__(self, listen_ip='127.0.0.1', listen_port=9040,
-                 control_port_offset=100, exclude_nodes = None,
-                 exclude_exits=None, exit_nodes=None, entry_nodes=None,
-                 verbose=False):
+                 control_port_offset=100, **kwargs):
 
-            super().__init__(
-                trans_ip = listen_ip,
-                trans_port = listen_port,
-                socks_ip = None,
-                socks_port = None,
-                control_port = listen_port + control_port_offset,
-                exclude_nodes = exclude_nodes,
-                exclude_exits = exclude_exits,
-                exit_nodes = exit_nodes,
-                entry_nodes = entry_nodes,
-                verbose = verbose)
+        super().__init__(
+            trans_ip = listen_ip,
+            trans_port = listen_port,
+            control_port = listen_port + control_port_offset,
+            **kwargs)
+        self.start()